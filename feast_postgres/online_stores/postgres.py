@@ -1,12 +1,31 @@
+import contextlib
+import hashlib
+import io
+import itertools
 import logging
-from collections import defaultdict
-from datetime import datetime
-from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from operator import itemgetter
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 import psycopg2
-import pytz
+from google.protobuf.internal import api_implementation
 from psycopg2 import sql
-from psycopg2.extras import execute_values
+from psycopg2.extensions import connection, cursor
+from psycopg2.pool import ThreadedConnectionPool
+from pydantic import PositiveInt
 from pydantic.schema import Literal
 
 from feast import Entity
@@ -16,25 +35,148 @@ from feast.infra.online_stores.online_store import OnlineStore
 from feast.protos.feast.types.EntityKey_pb2 import EntityKey as EntityKeyProto
 from feast.protos.feast.types.Value_pb2 import Value as ValueProto
 from feast.repo_config import RepoConfig
-from feast_postgres.utils import _get_conn
+from feast_postgres.utils import _get_conn_pool
 
 from ..postgres_config import PostgreSQLConfig
 
+logger = logging.getLogger(__name__)
+
+# A row of an online store table:
+# (entity_key, feature_name, value, event_ts, created_ts)
+_Row = Tuple[bytes, str, bytes, datetime, Optional[datetime]]
+
+# Temporary table the rows of online_write_batch are copied into before the upsert
+_STAGING_TABLE = "feast_online_write_staging"
+# Characters that have to be escaped in COPY's text format
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+# The queries that online_write_batch and online_read run for a table
+_QUERIES = {
+    "stage": sql.SQL(
+        """
+        CREATE TEMPORARY TABLE IF NOT EXISTS {staging}
+        (
+            entity_key BYTEA,
+            feature_name TEXT,
+            value BYTEA,
+            event_ts TIMESTAMPTZ,
+            created_ts TIMESTAMPTZ
+        ) ON COMMIT DELETE ROWS;
+        """
+    ),
+    "copy": sql.SQL(
+        """
+        COPY {staging} (entity_key, feature_name, value, event_ts, created_ts)
+        FROM STDIN
+        """
+    ),
+    # ON CONFLICT can't update the same row twice in one statement, so only the
+    # latest value of each feature is taken from the staged rows
+    "upsert": sql.SQL(
+        """
+        INSERT INTO {table}
+        (entity_key, feature_name, value, event_ts, created_ts)
+        SELECT DISTINCT ON (entity_key, feature_name)
+            entity_key, feature_name, value, event_ts, created_ts
+        FROM {staging}
+        ORDER BY entity_key, feature_name, event_ts DESC, created_ts DESC NULLS LAST
+        ON CONFLICT (entity_key, feature_name) DO
+        UPDATE SET
+            value = EXCLUDED.value,
+            event_ts = EXCLUDED.event_ts,
+            created_ts = EXCLUDED.created_ts;
+        """
+    ),
+    "prepare_read": sql.SQL(
+        """
+        PREPARE {statement} (BYTEA[], TEXT[]) AS
+        SELECT entity_key, feature_name, value, event_ts
+        FROM {table}
+        WHERE entity_key = ANY($1)
+        AND ($2 IS NULL OR feature_name = ANY($2))
+        ORDER BY entity_key;
+        """
+    ),
+    "read": sql.SQL("EXECUTE {statement} (%(keys)s, %(features)s)"),
+    # The read query without preparing it, for connections that can't keep a
+    # prepared statement between transactions
+    "read_unprepared": sql.SQL(
+        """
+        SELECT entity_key, feature_name, value, event_ts
+        FROM {table}
+        WHERE entity_key = ANY(%(keys)s::BYTEA[])
+        AND (%(features)s::TEXT[] IS NULL OR feature_name = ANY(%(features)s::TEXT[]))
+        ORDER BY entity_key;
+        """
+    ),
+}
+
 
 class PostgreSQLOnlineStoreConfig(PostgreSQLConfig):
     type: Literal[
         "feast_postgres.PostgreSQLOnlineStore"
     ] = "feast_postgres.PostgreSQLOnlineStore"
+    # Maximum number of connections kept open to PostgreSQL
+    pool_size: PositiveInt = 10
+    # Number of rows that online_write_batch formats and reports progress for at
+    # a time
+    batch_size: PositiveInt = 1000
+    # Whether online_write_batch waits for its commit to be flushed to disk. Turning
+    # it off makes writes faster, but the most recent writes can be lost, though
+    # not corrupted, if the PostgreSQL server crashes
+    synchronous_commit: bool = True
+    # Include the read columns in the entity key index so that reads can be served
+    # with index-only scans. Requires PostgreSQL 11+, limits a feature value to
+    # roughly 2.7kB, the maximum size of a btree index row, and makes upserts write
+    # to the index, so it's only worth it for tables that are rarely written to
+    covering_index: bool = False
+    # Set when connecting through a pooler in transaction mode, such as PgBouncer's
+    # pool_mode = transaction, where each transaction can run in a different server
+    # session. The staging table is then created by every write, and reads aren't
+    # prepared, since neither outlives a transaction in that case
+    transaction_pooling: bool = False
 
 
 class PostgreSQLOnlineStore(OnlineStore):
-    _conn: Optional[psycopg2._psycopg.connection] = None
+    _conn_pool: Optional[ThreadedConnectionPool] = None
+    _conn_pool_lock = threading.Lock()
+    _conn_pool_semaphore: Optional[threading.BoundedSemaphore] = None
 
-    def _get_conn(self, config: RepoConfig):
-        if not self._conn:
-            assert config.online_store.type == "feast_postgres.PostgreSQLOnlineStore"
-            self._conn = _get_conn(config.online_store)
-        return self._conn
+    def __init__(self):
+        super().__init__()
+        # The queries of _QUERIES, composed for a table, by (project, table, kind)
+        self._queries: Dict[Tuple[str, str, str], str] = {}
+        # The (project, table) whose read statement has been prepared in each
+        # pooled connection
+        self._prepared_reads: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        # The pooled connections that have created the staging table
+        self._staging_conns: weakref.WeakSet = weakref.WeakSet()
+
+    @contextlib.contextmanager
+    def _get_conn(self, config: RepoConfig) -> Iterator[connection]:
+        if not self._conn_pool:
+            with self._conn_pool_lock:
+                if not self._conn_pool:
+                    assert (
+                        config.online_store.type
+                        == "feast_postgres.PostgreSQLOnlineStore"
+                    )
+                    pool_size = config.online_store.pool_size
+                    # The pool raises an error rather than waiting when all of its
+                    # connections are in use, so the semaphore makes us wait instead
+                    self._conn_pool_semaphore = threading.BoundedSemaphore(pool_size)
+                    self._conn_pool = _get_conn_pool(config.online_store, pool_size)
+
+        assert self._conn_pool and self._conn_pool_semaphore
+        with self._conn_pool_semaphore:
+            conn = self._conn_pool.getconn()
+            try:
+                # Commits the transaction, or rolls it back on an error, before the
+                # connection goes back into the pool
+                with conn:
+                    yield conn
+            finally:
+                self._conn_pool.putconn(conn, close=bool(conn.closed))
 
     def online_write_batch(
         self,
@@ -48,46 +190,34 @@ class PostgreSQLOnlineStore(OnlineStore):
         project = config.project
 
         with self._get_conn(config) as conn, conn.cursor() as cur:
-            insert_values = []
-            for entity_key, values, timestamp, created_ts in data:
-                entity_key_bin = serialize_entity_key(entity_key)
-                timestamp = _to_naive_utc(timestamp)
-                if created_ts is not None:
-                    created_ts = _to_naive_utc(created_ts)
-
-                for feature_name, val in values.items():
-                    insert_values.append(
-                        (
-                            entity_key_bin,
-                            feature_name,
-                            val.SerializeToString(),
-                            timestamp,
-                            created_ts,
-                        )
-                    )
-            # Controll the batch so that we can update the progress
-            batch_size = 5000
-            for i in range(0, len(insert_values), batch_size):
-                cur_batch = insert_values[i : i + batch_size]
-                execute_values(
-                    cur,
-                    sql.SQL(
-                        """
-                        INSERT INTO {}
-                        (entity_key, feature_name, value, event_ts, created_ts)
-                        VALUES %s
-                        ON CONFLICT (entity_key, feature_name) DO
-                        UPDATE SET
-                            value = EXCLUDED.value,
-                            event_ts = EXCLUDED.event_ts,
-                            created_ts = EXCLUDED.created_ts;
-                        """,
-                    ).format(sql.Identifier(_table_id(project, table))),
-                    cur_batch,
-                    page_size=batch_size,
+            # Stage the rows in a temporary table with COPY, which is much cheaper
+            # to parse than a multi-row INSERT, and then upsert them all at once.
+            # The staging table lives as long as the connection and is emptied by
+            # every commit, so it's only created by the connection's first write
+            if (
+                config.online_store.transaction_pooling
+                or conn not in self._staging_conns
+            ):
+                cur.execute(self._get_query(conn, project, table, "stage"))
+            # All the batches are streamed through a single COPY so that we don't
+            # wait for a round trip per batch. The batches are still controlled so
+            # that we can update the progress
+            batch_size = config.online_store.batch_size
+            with _CopyStream(
+                _batched(_to_rows(data), batch_size), progress
+            ) as copy_stream:
+                cur.copy_expert(
+                    self._get_query(conn, project, table, "copy"), copy_stream
                 )
-                if progress:
-                    progress(len(cur_batch))
+            upsert = self._get_query(conn, project, table, "upsert")
+            if not config.online_store.synchronous_commit:
+                # Don't wait for the WAL to be flushed to disk when committing
+                upsert = "SET LOCAL synchronous_commit = OFF;" + upsert
+            cur.execute(upsert)
+
+        # Creating the staging table is rolled back along with a failed write, so
+        # the connection only counts as having it once the write has committed
+        self._staging_conns.add(conn)
 
     def online_read(
         self,
@@ -96,8 +226,7 @@ class PostgreSQLOnlineStore(OnlineStore):
         entity_keys: List[EntityKeyProto],
         requested_features: Optional[List[str]] = None,
     ) -> List[Tuple[Optional[datetime], Optional[Dict[str, ValueProto]]]]:
-        result: List[Tuple[Optional[datetime], Optional[Dict[str, ValueProto]]]] = []
-
+        _warn_if_python_protobuf()
         project = config.project
         with self._get_conn(config) as conn, conn.cursor() as cur:
             # Collecting all the keys to a list allows us to make fewer round trips
@@ -106,40 +235,54 @@ class PostgreSQLOnlineStore(OnlineStore):
             for entity_key in entity_keys:
                 keys.append(serialize_entity_key(entity_key))
 
-            cur.execute(
-                sql.SQL(
-                    """
-                    SELECT entity_key, feature_name, value, event_ts
-                    FROM {} WHERE entity_key = ANY(%s);
-                    """
-                ).format(
-                    sql.Identifier(_table_id(project, table)),
-                ),
-                (keys,),
-            )
+            psycopg2.extensions.register_type(_BYTEA_AS_BYTES, cur)
+            if config.online_store.transaction_pooling:
+                read = self._get_query(conn, project, table, "read_unprepared")
+            else:
+                self._prepare_read(conn, cur, project, table)
+                read = self._get_query(conn, project, table, "read")
+            # Only the requested features are fetched, or all of them if None
+            cur.execute(read, {"keys": keys, "features": requested_features})
+
+            # Iterating the cursor, rather than calling fetchall, only creates the
+            # Python tuple of a row as it's merged
+            return _merge_read_rows(keys, cur)
 
-            rows = cur.fetchall()
-
-            # Since we don't know the order returned from PostgreSQL we'll need
-            # to construct a dict to be able to quickly look up the correct row
-            # when we iterate through the keys since they are in the correct order
-            values_dict = defaultdict(list)
-            for row in rows if rows is not None else []:
-                values_dict[row[0].tobytes()].append(row[1:])
-
-            for key in keys:
-                if key in values_dict:
-                    value = values_dict[key]
-                    res = {}
-                    for feature_name, value_bin, event_ts in value:
-                        val = ValueProto()
-                        val.ParseFromString(value_bin)
-                        res[feature_name] = val
-                    result.append((event_ts, res))
-                else:
-                    result.append((None, None))
-
-        return result
+    def _prepare_read(
+        self, conn: connection, cur: cursor, project: str, table: FeatureView
+    ):
+        """
+        Prepare the statement that online_read runs for the table, unless the
+        connection has done so already, to save parsing and planning it per read
+        """
+        # Prepared statements only exist in the session that prepared them
+        prepared = self._prepared_reads.setdefault(conn, set())
+        if (project, table.name) not in prepared:
+            cur.execute(self._get_query(conn, project, table, "prepare_read"))
+            prepared.add((project, table.name))
+
+    def _get_query(
+        self, conn: connection, project: str, table: FeatureView, kind: str
+    ) -> str:
+        """
+        Get one of the _QUERIES for the table. Composing a query and quoting its
+        identifiers is only done the first time it's used.
+        """
+        key = (project, table.name, kind)
+        query = self._queries.get(key)
+        if query is None:
+            table_id = _table_id(project, table)
+            query = (
+                _QUERIES[kind]
+                .format(
+                    table=sql.Identifier(table_id),
+                    staging=sql.Identifier(_STAGING_TABLE),
+                    statement=sql.Identifier(_read_statement_name(table_id)),
+                )
+                .as_string(conn)
+            )
+            self._queries[key] = query
+        return query
 
     def update(
         self,
@@ -165,9 +308,13 @@ class PostgreSQLOnlineStore(OnlineStore):
                 (schema_name,),
             )
             schema_exists = cur.fetchone()
+
+            # All the DDL is sent as one batch of statements to avoid a round trip
+            # per table
+            statements = []
             if not schema_exists:
-                cur.execute(
-                    sql.SQL("CREATE SCHEMA IF NOT EXISTS {} AUTHORIZATION {}").format(
+                statements.append(
+                    sql.SQL("CREATE SCHEMA IF NOT EXISTS {} AUTHORIZATION {};").format(
                         sql.Identifier(schema_name),
                         sql.Identifier(config.online_store.user),
                     ),
@@ -175,11 +322,18 @@ class PostgreSQLOnlineStore(OnlineStore):
 
             for table in tables_to_delete:
                 table_name = _table_id(project, table)
-                cur.execute(_drop_table_and_index(table_name))
+                statements.append(_drop_table_and_index(table_name))
 
+            # Including the columns that online_read selects in the index lets
+            # PostgreSQL answer reads with index-only scans
+            index_include = (
+                sql.SQL("INCLUDE (feature_name, value, event_ts)")
+                if config.online_store.covering_index
+                else sql.SQL("")
+            )
             for table in tables_to_keep:
                 table_name = _table_id(project, table)
-                cur.execute(
+                statements.append(
                     sql.SQL(
                         """
                         CREATE TABLE IF NOT EXISTS {}
@@ -191,15 +345,19 @@ class PostgreSQLOnlineStore(OnlineStore):
                             created_ts TIMESTAMPTZ,
                             PRIMARY KEY(entity_key, feature_name)
                         );
-                        CREATE INDEX IF NOT EXISTS {} ON {} (entity_key);
+                        CREATE INDEX IF NOT EXISTS {} ON {} (entity_key) {};
                         """
                     ).format(
                         sql.Identifier(table_name),
                         sql.Identifier(f"{table_name}_ek"),
                         sql.Identifier(table_name),
+                        index_include,
                     )
                 )
 
+            if statements:
+                cur.execute(sql.Composed(statements))
+
             conn.commit()
 
     def teardown(
@@ -210,19 +368,172 @@ class PostgreSQLOnlineStore(OnlineStore):
     ):
         project = config.project
         try:
+            if not tables:
+                return
             with self._get_conn(config) as conn, conn.cursor() as cur:
-                for table in tables:
-                    table_name = _table_id(project, table)
-                    cur.execute(_drop_table_and_index(table_name))
+                cur.execute(
+                    sql.Composed(
+                        [
+                            _drop_table_and_index(_table_id(project, table))
+                            for table in tables
+                        ]
+                    )
+                )
         except Exception:
             logging.exception("Teardown failed")
             raise
 
 
+class _CopyStream(io.TextIOBase):
+    """
+    Readable file object for COPY FROM STDIN that formats the batches of rows
+    lazily, as psycopg2 reads them, and reports the progress of each batch.
+
+    The next batch is serialized and formatted in a background thread while
+    psycopg2 sends the current one, which it does with the GIL released.
+    """
+
+    def __init__(
+        self,
+        batches: Iterator[List[_Row]],
+        progress: Optional[Callable[[int], Any]],
+    ):
+        self._batches = batches
+        self._progress = progress
+        self._batch_size = 0
+        self._buffer = io.StringIO()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._next_batch = self._executor.submit(self._format_next_batch)
+
+    def _format_next_batch(self) -> Tuple[int, str]:
+        batch = next(self._batches, None)
+        if batch is None:
+            return 0, ""
+        return len(batch), "".join(map(_to_copy_line, batch))
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> str:
+        if size is None or size < 0:
+            return "".join(iter(lambda: self.read(io.DEFAULT_BUFFER_SIZE), ""))
+
+        data = self._buffer.read(size)
+        while not data:
+            # The previous batch has been read in full by now
+            if self._progress and self._batch_size:
+                self._progress(self._batch_size)
+            self._batch_size, text = self._next_batch.result()
+            if not self._batch_size:
+                return ""
+            self._next_batch = self._executor.submit(self._format_next_batch)
+            self._buffer = io.StringIO(text)
+            data = self._buffer.read(size)
+        return data
+
+    def close(self):
+        self._executor.shutdown()
+        super().close()
+
+
+def _to_rows(
+    data: List[
+        Tuple[EntityKeyProto, Dict[str, ValueProto], datetime, Optional[datetime]]
+    ],
+) -> Iterator[_Row]:
+    """
+    Lazily produce a row for each feature value so that all the rows never have to
+    be held in memory at once
+    """
+    # This loop runs for every feature value, so the method is looked up once
+    # rather than per call
+    serialize_value = ValueProto.SerializeToString
+    for entity_key, values, timestamp, created_ts in data:
+        entity_key_bin = serialize_entity_key(entity_key)
+        timestamp = _to_naive_utc(timestamp)
+        if created_ts is not None:
+            created_ts = _to_naive_utc(created_ts)
+
+        for feature_name, val in values.items():
+            yield (
+                entity_key_bin,
+                feature_name,
+                serialize_value(val),
+                timestamp,
+                created_ts,
+            )
+
+
+def _batched(rows: Iterator[_Row], batch_size: int) -> Iterator[List[_Row]]:
+    batch = list(itertools.islice(rows, batch_size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(rows, batch_size))
+
+
+_python_protobuf_warned = False
+
+
+def _warn_if_python_protobuf():
+    # Parsing the feature values is a large part of online_read, and the pure
+    # Python protobuf implementation is an order of magnitude slower than the
+    # native ones
+    global _python_protobuf_warned
+    if not _python_protobuf_warned:
+        _python_protobuf_warned = True
+        if api_implementation.Type() == "python":
+            logger.warning(
+                "protobuf is using its pure Python implementation, which makes "
+                "reading from the PostgreSQL online store slow. Install a protobuf "
+                "release with a C++ or upb backend, or unset "
+                "PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION."
+            )
+
+
+def _merge_read_rows(
+    keys: List[bytes], rows: Iterable[Tuple[bytes, str, bytes, datetime]]
+) -> List[Tuple[Optional[datetime], Optional[Dict[str, ValueProto]]]]:
+    """
+    Build the result of online_read for the serialized entity keys from the rows
+    read for them, which are sorted by entity key
+    """
+    # Instead of grouping the rows in a dict, they are merged with the keys sorted
+    # the same way. Python and PostgreSQL compare bytes the same way
+    result: List[Tuple[Optional[datetime], Optional[Dict[str, ValueProto]]]] = [
+        (None, None)
+    ] * len(keys)
+    parse_value = ValueProto.FromString
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    i = 0
+    for key, group in itertools.groupby(rows, key=itemgetter(0)):
+        # Each group is split into columns and built into a dict by zip, map and
+        # dict, so there's no Python bytecode run per row
+        _, feature_names, value_bins, event_tss = zip(*group)
+        res = dict(zip(feature_names, map(parse_value, value_bins)))
+        event_ts = event_tss[-1]
+        # Keys without any rows keep their (None, None)
+        while i < len(order) and keys[order[i]] < key:
+            i += 1
+        if i < len(order) and keys[order[i]] == key:
+            result[order[i]] = (event_ts, res)
+            i += 1
+            # A key that is read more than once gets a dict of its own each time
+            while i < len(order) and keys[order[i]] == key:
+                result[order[i]] = (event_ts, dict(res))
+                i += 1
+    return result
+
+
 def _table_id(project: str, table: FeatureView) -> str:
     return f"{project}_{table.name}"
 
 
+def _read_statement_name(table_id: str) -> str:
+    # Table ids can be longer than the 63 bytes PostgreSQL keeps of an identifier,
+    # so a digest of the id is used to keep the names of the statements distinct
+    return f"feast_read_{hashlib.md5(table_id.encode()).hexdigest()}"
+
+
 def _drop_table_and_index(table_name):
     return sql.SQL(
         """
@@ -235,8 +546,41 @@ def _drop_table_and_index(table_name):
     )
 
 
+def _to_copy_line(row: _Row) -> str:
+    """
+    Format a row to be inserted as a line of COPY's text format
+    """
+    entity_key_bin, feature_name, value, timestamp, created_ts = row
+    # Backslashes are escaped in the text format, so the bytea hex prefix is "\\x"
+    return "\\\\x{}\t{}\t\\\\x{}\t{}\t{}\n".format(
+        entity_key_bin.hex(),
+        feature_name.translate(_COPY_ESCAPES),
+        value.hex(),
+        timestamp.isoformat(),
+        created_ts.isoformat() if created_ts is not None else "\\N",
+    )
+
+
+def _cast_bytea(value: Optional[str], cur: cursor) -> Optional[bytes]:
+    if value is None:
+        return None
+    # PostgreSQL sends bytea in the hex format unless bytea_output says otherwise
+    if value.startswith("\\x"):
+        return bytes.fromhex(value[2:])
+    return bytes(psycopg2.BINARY(value, cur))
+
+
+# psycopg2 returns bytea as memoryview, which can't be used as a dict key, so the
+# online store reads it as bytes instead
+_BYTEA_AS_BYTES = psycopg2.extensions.new_type(
+    psycopg2.BINARY.values, "BYTEA_AS_BYTES", _cast_bytea
+)
+
+
 def _to_naive_utc(ts: datetime):
     if ts.tzinfo is None:
         return ts
+    elif ts.tzinfo is timezone.utc:
+        return ts.replace(tzinfo=None)
     else:
-        return ts.astimezone(pytz.utc).replace(tzinfo=None)
+        return ts.astimezone(timezone.utc).replace(tzinfo=None)
@@ -1,16 +1,40 @@
-from typing import Dict
+from typing import Any, Dict
 
 import numpy as np
 import pandas as pd
 import psycopg2
+import psycopg2.extras
 import pyarrow as pa
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 
 from feast_postgres.postgres_config import PostgreSQLConfig
 from feast_postgres.type_map import arrow_to_pg_type
 
+# Number of rows df_to_postgres_table inserts per statement
+_UNNEST_BATCH_SIZE = 10000
+
 
 def _get_conn(config: PostgreSQLConfig):
-    conn = psycopg2.connect(
+    conn = psycopg2.connect(**_get_conn_kwargs(config))
+    return conn
+
+
+def _get_conn_pool(config: PostgreSQLConfig, maxconn: int) -> ThreadedConnectionPool:
+    conn_pool = ThreadedConnectionPool(
+        minconn=1,
+        maxconn=maxconn,
+        **_get_conn_kwargs(config),
+    )
+    # The pool closes the connections put back into it once it holds minconn of
+    # them. Raising minconn after the pool has been created keeps every connection
+    # open for reuse, while they're still only opened as they're needed
+    conn_pool.minconn = maxconn
+    return conn_pool
+
+
+def _get_conn_kwargs(config: PostgreSQLConfig) -> Dict[str, Any]:
+    return dict(
         dbname=config.database,
         host=config.host,
         port=int(config.port),
@@ -18,7 +42,6 @@ def _get_conn(config: PostgreSQLConfig):
         password=config.password,
         options="-c search_path={}".format(config.db_schema or config.user),
     )
-    return conn
 
 
 def df_to_create_table_sql(entity_df, table_name) -> str:
@@ -39,16 +62,44 @@ def df_to_postgres_table(
     """
     Create a table for the data frame, insert all the values, and return the table schema
     """
+    # The index isn't inserted, so it's left out of the types of the columns
+    pg_types = [
+        arrow_to_pg_type(str(f.type))
+        for f in pa.Table.from_pandas(df, preserve_index=False).schema
+    ]
+    values = df.replace({np.NaN: None})
     with _get_conn(config) as conn, conn.cursor() as cur:
         cur.execute(df_to_create_table_sql(df, table_name))
-        psycopg2.extras.execute_values(
-            cur,
-            f"""
-            INSERT INTO {table_name}
-            VALUES %s
-            """,
-            df.replace({np.NaN: None}).to_numpy(),
-        )
+        if any(pg_type.endswith("[]") for pg_type in pg_types):
+            # UNNEST would flatten array columns, so those rows have to be sent
+            # as VALUES
+            psycopg2.extras.execute_values(
+                cur,
+                f"""
+                INSERT INTO {table_name}
+                VALUES %s
+                """,
+                values.to_numpy(),
+            )
+        else:
+            # Sending each column as an array and unnesting them on the server
+            # inserts a whole batch of rows with one statement. psycopg2 inlines
+            # the arrays in the query, so the batches keep its size bounded
+            insert_sql = sql.SQL("INSERT INTO {} ({}) SELECT * FROM UNNEST({})").format(
+                sql.Identifier(table_name),
+                sql.SQL(", ").join(
+                    sql.Identifier(str(column)) for column in df.columns
+                ),
+                sql.SQL(", ").join(
+                    sql.SQL("%s::{}[]").format(sql.SQL(pg_type)) for pg_type in pg_types
+                ),
+            )
+            for i in range(0, len(values), _UNNEST_BATCH_SIZE):
+                batch = values.iloc[i : i + _UNNEST_BATCH_SIZE]
+                cur.execute(
+                    insert_sql,
+                    [batch[column].tolist() for column in batch.columns],
+                )
         return dict(zip(df.columns, df.dtypes))
 
 
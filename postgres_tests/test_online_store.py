@@ -0,0 +1,218 @@
+from datetime import datetime
+
+import psycopg2
+import pytest
+from pydantic import ValidationError
+
+from feast.protos.feast.types.Value_pb2 import Value as ValueProto
+from feast_postgres.online_stores.postgres import (
+    PostgreSQLOnlineStoreConfig,
+    _batched,
+    _cast_bytea,
+    _CopyStream,
+    _merge_read_rows,
+    _to_copy_line,
+)
+
+
+@pytest.mark.parametrize("field", ["pool_size", "batch_size"])
+@pytest.mark.parametrize("value", [0, -1])
+def test_config_rejects_non_positive_sizes(field, value):
+    with pytest.raises(ValidationError):
+        PostgreSQLOnlineStoreConfig(
+            host="localhost",
+            database="postgres",
+            user="user",
+            password="password",
+            **{field: value},
+        )
+
+
+def _copy_fields(line: str):
+    assert line.endswith("\n")
+    return line[:-1].split("\t")
+
+
+def test_to_copy_line_formats_bytea_as_escaped_hex():
+    line = _to_copy_line(
+        (b"\x00\x01\xff", "feature", b"\x0a\x09", datetime(2021, 4, 12, 10, 59), None)
+    )
+    entity_key, feature_name, value, event_ts, created_ts = _copy_fields(line)
+    # COPY unescapes "\\x" into the "\x" prefix of bytea's hex format
+    assert entity_key == "\\\\x0001ff"
+    assert feature_name == "feature"
+    assert value == "\\\\x0a09"
+    assert event_ts == "2021-04-12T10:59:00"
+    assert created_ts == "\\N"
+
+
+def test_to_copy_line_formats_timestamps():
+    line = _to_copy_line(
+        (
+            b"",
+            "feature",
+            b"",
+            datetime(2021, 4, 12, 10, 59, 42, 123),
+            datetime(2021, 4, 13),
+        )
+    )
+    _, _, _, event_ts, created_ts = _copy_fields(line)
+    assert event_ts == "2021-04-12T10:59:42.000123"
+    assert created_ts == "2021-04-13T00:00:00"
+
+
+@pytest.mark.parametrize(
+    "feature_name, escaped",
+    [
+        ("a\tb", "a\\tb"),
+        ("a\nb", "a\\nb"),
+        ("a\rb", "a\\rb"),
+        ("a\\b", "a\\\\b"),
+        ("a\\tb", "a\\\\tb"),
+    ],
+)
+def test_to_copy_line_escapes_feature_name(feature_name, escaped):
+    line = _to_copy_line((b"", feature_name, b"", datetime(2021, 4, 12), None))
+    fields = _copy_fields(line)
+    assert len(fields) == 5
+    assert fields[1] == escaped
+
+
+def test_cast_bytea_hex_format():
+    assert _cast_bytea("\\x0001ff", None) == b"\x00\x01\xff"
+    assert _cast_bytea("\\x", None) == b""
+
+
+def test_cast_bytea_escape_format():
+    value = _cast_bytea("\\000a\\377", None)
+    assert value == b"\x00a\xff"
+    assert isinstance(value, bytes)
+
+
+def test_cast_bytea_null():
+    assert _cast_bytea(None, None) is None
+
+
+def test_cast_bytea_matches_psycopg2():
+    for value in ["\\x0a0b", "abc\\\\def"]:
+        assert _cast_bytea(value, None) == bytes(psycopg2.BINARY(value, None))
+
+
+def _read_row(key: bytes, feature_name: str, value: int, event_ts: datetime):
+    return key, feature_name, ValueProto(int64_val=value).SerializeToString(), event_ts
+
+
+def test_merge_read_rows_in_order_of_keys():
+    ts = datetime(2021, 4, 12)
+    rows = [
+        _read_row(b"a", "trips", 1, ts),
+        _read_row(b"a", "rate", 2, ts),
+        _read_row(b"b", "trips", 3, ts),
+    ]
+    result = _merge_read_rows([b"b", b"a"], rows)
+    assert result == [
+        (ts, {"trips": ValueProto(int64_val=3)}),
+        (ts, {"trips": ValueProto(int64_val=1), "rate": ValueProto(int64_val=2)}),
+    ]
+
+
+def test_merge_read_rows_missing_keys():
+    ts = datetime(2021, 4, 12)
+    rows = [_read_row(b"b", "trips", 1, ts)]
+    result = _merge_read_rows([b"c", b"b", b"a"], rows)
+    assert result == [
+        (None, None),
+        (ts, {"trips": ValueProto(int64_val=1)}),
+        (None, None),
+    ]
+
+
+def test_merge_read_rows_duplicate_keys():
+    ts = datetime(2021, 4, 12)
+    rows = [_read_row(b"a", "trips", 1, ts), _read_row(b"b", "trips", 2, ts)]
+    result = _merge_read_rows([b"b", b"a", b"b"], rows)
+    assert result == [
+        (ts, {"trips": ValueProto(int64_val=2)}),
+        (ts, {"trips": ValueProto(int64_val=1)}),
+        (ts, {"trips": ValueProto(int64_val=2)}),
+    ]
+    # Each duplicate gets its own dict
+    assert result[0][1] is not result[2][1]
+
+
+def test_merge_read_rows_takes_last_event_ts():
+    rows = [
+        _read_row(b"a", "trips", 1, datetime(2021, 4, 12)),
+        _read_row(b"a", "rate", 2, datetime(2021, 4, 13)),
+    ]
+    [(event_ts, _)] = _merge_read_rows([b"a"], rows)
+    assert event_ts == datetime(2021, 4, 13)
+
+
+def test_merge_read_rows_ignores_rows_of_other_keys():
+    ts = datetime(2021, 4, 12)
+    rows = [_read_row(b"a", "trips", 1, ts), _read_row(b"z", "trips", 2, ts)]
+    assert _merge_read_rows([b"a"], rows) == [(ts, {"trips": ValueProto(int64_val=1)})]
+
+
+def test_merge_read_rows_no_keys():
+    assert _merge_read_rows([], []) == []
+
+
+def _copy_rows(count: int):
+    return [
+        (b"\x01", f"feature_{i}", b"\x02", datetime(2021, 4, 12), None)
+        for i in range(count)
+    ]
+
+
+def test_copy_stream_reports_progress_per_batch():
+    progress = []
+    rows = _copy_rows(5)
+    with _CopyStream(_batched(iter(rows), 2), progress.append) as copy_stream:
+        text = copy_stream.read()
+    assert text == "".join(map(_to_copy_line, rows))
+    assert progress == [2, 2, 1]
+
+
+def test_copy_stream_small_reads():
+    progress = []
+    rows = _copy_rows(3)
+    with _CopyStream(_batched(iter(rows), 2), progress.append) as copy_stream:
+        text = "".join(iter(lambda: copy_stream.read(7), ""))
+    assert text == "".join(map(_to_copy_line, rows))
+    assert progress == [2, 1]
+
+
+def test_copy_stream_reads_after_end():
+    progress = []
+    with _CopyStream(_batched(iter(_copy_rows(1)), 2), progress.append) as copy_stream:
+        assert copy_stream.read(-1)
+        assert copy_stream.read(-1) == ""
+        assert copy_stream.read(10) == ""
+    assert progress == [1]
+
+
+def test_copy_stream_without_rows():
+    with _CopyStream(_batched(iter([]), 2), None) as copy_stream:
+        assert copy_stream.read() == ""
+
+
+def test_copy_stream_raises_errors_of_the_worker():
+    def batches():
+        yield _copy_rows(1)
+        raise ValueError("bad row")
+
+    progress = []
+    with _CopyStream(batches(), progress.append) as copy_stream:
+        with pytest.raises(ValueError, match="bad row"):
+            copy_stream.read()
+    assert progress == [1]
+
+
+def test_copy_stream_shuts_down_executor_on_close():
+    copy_stream = _CopyStream(_batched(iter(_copy_rows(1)), 2), None)
+    copy_stream.close()
+    assert copy_stream.closed
+    with pytest.raises(RuntimeError):
+        copy_stream._executor.submit(print)
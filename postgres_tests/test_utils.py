@@ -0,0 +1,57 @@
+from unittest import mock
+
+import pandas as pd
+import psycopg2.extensions
+
+from feast_postgres.postgres_config import PostgreSQLConfig
+from feast_postgres.utils import _get_conn_pool, df_to_postgres_table
+
+_CONFIG = PostgreSQLConfig(
+    host="localhost", database="postgres", user="user", password="password"
+)
+
+
+def _mock_connect(connections):
+    def connect(*args, **kwargs):
+        conn = mock.MagicMock(closed=0)
+        conn.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        conn.close.side_effect = lambda: setattr(conn, "closed", 1)
+        connections.append(conn)
+        return conn
+
+    return connect
+
+
+def test_conn_pool_keeps_returned_connections_open():
+    connections = []
+    with mock.patch("psycopg2.pool.psycopg2.connect", _mock_connect(connections)):
+        conn_pool = _get_conn_pool(_CONFIG, maxconn=10)
+        for _ in range(3):
+            first, second = conn_pool.getconn(), conn_pool.getconn()
+            conn_pool.putconn(first)
+            conn_pool.putconn(second)
+
+    assert len(connections) == 2
+    assert not any(conn.closed for conn in connections)
+
+
+def test_conn_pool_opens_connections_lazily():
+    connections = []
+    with mock.patch("psycopg2.pool.psycopg2.connect", _mock_connect(connections)):
+        _get_conn_pool(_CONFIG, maxconn=10)
+
+    assert len(connections) == 1
+
+
+def test_df_to_postgres_table_inserts_array_columns_as_values():
+    df = pd.DataFrame({"driver_id": [1001, 1002], "trips": [[1, 2], [3]]})
+    with mock.patch("feast_postgres.utils._get_conn") as get_conn, mock.patch(
+        "feast_postgres.utils.psycopg2.extras.execute_values"
+    ) as execute_values:
+        df_to_postgres_table(_CONFIG, df, "entity_df")
+
+    conn = get_conn.return_value.__enter__.return_value
+    cur, insert_sql, values = execute_values.call_args[0]
+    assert cur is conn.cursor.return_value.__enter__.return_value
+    assert "INSERT INTO entity_df" in insert_sql
+    assert values.tolist() == [[1001, [1, 2]], [1002, [3]]]